@@ -1,15 +1,91 @@
 #! /usr/bin/python3
 # coding: utf-8
 
-import decimal
+import numpy as np
 import pandas as pd
 import sqlite3
 import logging
 import os
+import re
 import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pacsv
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    pa = None
+    CSV_ENGINE = 'c'
 pd.options.mode.chained_assignment = None
-decimal.getcontext().rounding = decimal.ROUND_HALF_UP
+
+
+def _round_half_up(arr, decimals=0):
+    """
+    Rounds array values half away from zero according to official standards
+    """
+    scale = 10 ** decimals
+    scaled = np.abs(arr) * scale
+    floor = np.floor(scaled)
+    return np.sign(arr) * np.where(scaled - floor >= 0.5, floor + 1, floor) / scale
+
+
+# Characters that make to_csv quote a cell
+CSV_SPECIAL_CHARS = r'[",\r\n]'
+
+
+def _to_arrow_table(data):
+    """
+    Converts data frame to an arrow table with cells formatted the way to_csv writes them,
+    returns None if any column can not be formatted identically
+    """
+    if any(re.search(CSV_SPECIAL_CHARS, str(name)) for name in data.columns):
+        return None
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        column = table.column(i)
+        if pa.types.is_dictionary(field.type):
+            column = column.cast(field.type.value_type)
+        column = _format_arrow_column(column)
+        if column is None:
+            return None
+        table = table.set_column(i, field.name, column)
+    return table
+
+
+def _format_arrow_column(column):
+    """
+    Formats arrow column like to_csv: floats keep a trailing .0, timestamps have +HH:MM offsets
+    and midnight-only datetimes are written as dates
+    """
+    if pa.types.is_integer(column.type):
+        return column
+    if pa.types.is_floating(column.type):
+        # Arrow and Python only agree on float formatting outside of scientific notation
+        values = np.abs(column.to_numpy(zero_copy_only=False))
+        values = values[np.isfinite(values) & (values != 0)]
+        if ((values < 1e-4) | (values >= 1e10)).any():
+            return None
+        return pc.replace_substring_regex(column.cast(pa.string()), pattern=r'^(-?\d+)$',
+                                          replacement=r'\1.0')
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        if pc.any(pc.match_substring_regex(column, CSV_SPECIAL_CHARS)).as_py():
+            return None
+        return column
+    if pa.types.is_timestamp(column.type):
+        try:
+            column = column.cast(pa.timestamp('s', tz=column.type.tz))
+        except pa.ArrowInvalid:
+            return None
+        if column.type.tz is not None:
+            column = pc.strftime(column, format='%Y-%m-%d %H:%M:%S%z')
+            return pc.replace_substring_regex(column, pattern=r'([+-]\d{2})(\d{2})$',
+                                              replacement=r'\1:\2')
+        if pc.all(pc.equal(pc.floor_temporal(column, unit='day'), column)).as_py() is not False:
+            return column.cast(pa.date32())
+        return column.cast(pa.string())
+    return None
 
 
 class Awair:
@@ -31,12 +107,14 @@ class Awair:
         pm10 monthly stats (csv)
     """
 
-    def __init__(self, input_file, log_level=logging.INFO):
+    def __init__(self, input_file, log_level=logging.INFO, executor=None):
         self.log = None
         self.data = None
         self.hourly = None
         self.daily = None
         self.monthly = None
+        self.executor = executor
+        self.exports = []
 
         self.configure_logger(log_level)
         self.read_data(input_file)
@@ -54,7 +132,7 @@ class Awair:
 
     def read_data(self, input_file):
         if not os.path.exists(input_file):
-            self.log.error(f"Input file does not exist")
+            self.log.error("Input file does not exist")
             sys.exit(1)
         extension = os.path.splitext(input_file)[1].lower()
         if extension == '.db':
@@ -62,8 +140,9 @@ class Awair:
         elif extension == '.csv':
             self.data = self._read_csv(input_file)
         else:
-            self.log.error(f"Invalid source extension. Permitted extensions are .db for sqlite file or .csv")
+            self.log.error("Invalid source extension. Permitted extensions are .db for sqlite file or .csv")
             sys.exit(1)
+        self.data['station_id'] = pd.Categorical(self.data['station_id'].astype('int32'))
 
     def _read_sqlite(self, db_path):
         """
@@ -71,9 +150,10 @@ class Awair:
         """
         conn = sqlite3.connect(db_path)
         data = pd.read_sql_query(
-            "SELECT station_id, measure_time, value FROM pm10", conn)
+            "SELECT station_id, measure_time, value FROM pm10", conn,
+            dtype={'station_id': 'int32', 'value': 'float64'})
         conn.close()
-        self.log.info(f"Loaded database content")
+        self.log.info("Loaded database content")
         return data
 
     def _read_csv(self, csv_path):
@@ -81,8 +161,10 @@ class Awair:
         Reads csv file
         """
         data = pd.read_csv(
-            csv_path, names=['station_id', 'measure_time', 'value'], skiprows=1)
-        self.log.info(f"Loaded csv file")
+            csv_path, names=['station_id', 'measure_time', 'value'], skiprows=1,
+            dtype={'station_id': 'int32', 'value': 'float64'},
+            engine=CSV_ENGINE)
+        self.log.info("Loaded csv file")
         return data
 
     def preprocess_data(self, output_dir, output_file='data.csv', sort_order=['station_id', 'measure_time'],
@@ -93,9 +175,11 @@ class Awair:
         assert self.data is not None
 
         self.convert_datetime()
+        self.sort_values(['station_id', 'measure_time'])
         self.remove_duplicates()
-        self.sort_values(sort_order)
         self.limit_time_range(lower_band, upper_band)
+        if list(sort_order) != ['station_id', 'measure_time']:
+            self.sort_values(sort_order)
         self.export_to_csv(self.data, output_dir, output_file)
 
     def generate_hourly_stats(self, output_dir, output_file='hourly_stats.csv'):
@@ -135,106 +219,138 @@ class Awair:
         """
         Converts inconsistent date formats
         """
+        measure_time = self.data['measure_time']
+        if not pd.api.types.is_datetime64_any_dtype(measure_time):
+            measure_time = self._parse_datetime(measure_time)
         self.data['measure_time'] = pd.to_datetime(
-            self.data['measure_time'], utc=True).dt.tz_convert('Europe/Vienna')
-        self.log.info(f"Converted inconsistent date formats")
+            measure_time, utc=True).dt.tz_convert('Europe/Vienna')
+        self.log.info("Converted inconsistent date formats")
+
+    def _parse_datetime(self, measure_time):
+        """
+        Parses ISO-8601 timestamps in a single pass, other formats element by element
+        """
+        try:
+            return pd.to_datetime(measure_time, format='ISO8601', utc=True, cache=True)
+        except ValueError:
+            return pd.to_datetime(measure_time, format='mixed', utc=True, cache=True)
 
     def remove_duplicates(self):
         """
-        Removes duplicated rows (based on timestamps)
+        Removes duplicated rows (based on timestamps), expects data sorted by station and time
         """
         len_old = len(self.data)
-        self.data = self.data.drop_duplicates()
+        station = self.data['station_id'].cat.codes.to_numpy()
+        measure_time = self.data['measure_time'].dt.tz_convert(None).to_numpy()
+        keep = np.ones(len_old, dtype=bool)
+        keep[1:] = (station[1:] != station[:-1]) | (measure_time[1:] != measure_time[:-1])
+        self.data = self.data[keep]
         diff = len_old - len(self.data)
-        self.log.info(f"Removed {diff} duplicated rows")
+        self.log.info("Removed %d duplicated rows", diff)
 
     def sort_values(self, order):
         """
         Sorts values
         """
-        self.data['station_id'] = self.data['station_id'].astype(int)
         self.data = self.data.sort_values(by=order)
-        self.log.info(f"Sorted values by {order}")
+        self.log.info("Sorted values by %s", order)
 
     def limit_time_range(self, lower_band, upper_band):
         """
         Limits data to a specified time range
         """
-        self.data = self.data[(self.data['measure_time'] >= lower_band) & (
-            self.data['measure_time'] < upper_band)]
-        self.log.info(f"Limited data to the time period between {lower_band} and {upper_band}")
+        tz = self.data['measure_time'].dt.tz
+        lower = pd.Timestamp(lower_band, tz=tz).tz_convert(None).to_datetime64()
+        upper = pd.Timestamp(upper_band, tz=tz).tz_convert(None).to_datetime64()
+        measure_time = self.data['measure_time'].dt.tz_convert(None).to_numpy()
+        self.data = self.data[(measure_time >= lower) & (measure_time < upper)]
+        self.log.info("Limited data to the time period between %s and %s", lower_band, upper_band)
 
     def export_to_csv(self, data, output_dir, output_file):
         """
-        Exports data to a csv file
+        Exports data to a csv file, in the background if an executor is set
         """
         output_path = os.path.join(output_dir, output_file)
-        data.to_csv(output_path, index=False)
-        self.log.info(f"Exported data to the file {output_path}")
+        if self.executor is not None:
+            self.exports.append(self.executor.submit(self._write_csv, data, output_path))
+        else:
+            self._write_csv(data, output_path)
 
-    def hourly_stats(self):
+    def _write_csv(self, data, output_path):
         """
-        Calculates the hourly average
+        Writes data to a csv file
         """
-        hourly = self.data[['station_id', 'value']]
-        hourly['date'] = self.data['measure_time'].dt.date
-        hourly['hour'] = self.data['measure_time'].dt.hour
-        hourly = hourly.groupby(['station_id', 'date', 'hour'], as_index=False)[
-            'value'].agg({'value': 'mean'})
-        hourly['value'] = hourly['value'].map(self._round_values)
-        self.log.info(f'Calculated the hourly average')
-        return hourly
+        table = _to_arrow_table(data) if pa is not None else None
+        if table is not None:
+            with open(output_path, 'wb') as output:
+                output.write((','.join(map(str, data.columns)) + os.linesep).encode('utf-8'))
+                pacsv.write_csv(table, output, write_options=pacsv.WriteOptions(
+                    include_header=False, quoting_style='none', eol=os.linesep))
+        else:
+            data.to_csv(output_path, index=False)
+        self.log.info("Exported data to the file %s", output_path)
 
-    def _round_values(self, value, precision="1."):
+    def hourly_stats(self):
         """
-        Converts float to Decimal and rounds according to official standards
+        Calculates the hourly average
         """
-        return decimal.Decimal(str(value)).quantize(decimal.Decimal(precision))
+        # Hours are binned in local time, so date and hour match the local clock
+        local_time = pd.DatetimeIndex(self.data['measure_time'].dt.tz_localize(None), name='hour_start')
+        hourly = pd.DataFrame({'station_id': self.data['station_id'].array,
+                               'value': self.data['value'].array}, index=local_time, copy=False)
+        hourly = hourly.groupby(['station_id', pd.Grouper(freq='h')], sort=False, observed=True)[
+            'value'].mean().reset_index()
+        # Sorting the reduced frame keeps the output order independent of the input sort order
+        hourly = hourly.sort_values(['station_id', 'hour_start'], ignore_index=True)
+        hour_start = hourly.pop('hour_start').dt
+        hourly.insert(1, 'date', hour_start.normalize())
+        hourly.insert(2, 'hour', hour_start.hour.astype('int8'))
+        hourly['value'] = _round_half_up(hourly['value'].to_numpy())
+        hourly['value'] = hourly['value'].astype('Int64')
+        self.log.info("Calculated the hourly average")
+        return hourly
 
     def daily_stats(self, min_hour=18):
         """
         Calculates daily average values (for days with minimum 75% hourly average values)
         """
-        daily = self.hourly.groupby(['station_id', 'date']).filter(
-            lambda x: x.hour.count() >= min_hour)
-        daily['value'] = daily['value'].astype(float)
-        daily = daily.groupby(['station_id', 'date'], as_index=False)['value'].agg({'min': 'min',
-                                                                                    'max': 'max',
-                                                                                    'mean': 'mean'})
-        daily[['min', 'max', 'mean']] = daily[[
-            'min', 'max', 'mean']].applymap(self._round_values)
-        self.log.info(f"Calculated daily average values")
+        # A single groupby gives both the stats and the number of hours used to filter days
+        daily = self.hourly.groupby(['station_id', 'date'], sort=False, observed=True)[
+            'value'].agg(['min', 'max', 'mean', 'size']).reset_index()
+        daily = daily[daily.pop('size') >= min_hour].sort_values(['station_id', 'date'], ignore_index=True)
+        daily[['min', 'max', 'mean']] = _round_half_up(daily[[
+            'min', 'max', 'mean']].to_numpy(dtype=np.float64, na_value=np.nan))
+        daily[['min', 'max', 'mean']] = daily[['min', 'max', 'mean']].astype('Int64')
+        self.log.info("Calculated daily average values")
         return daily
 
     def monthly_stats(self):
         """
         Calculates monthly stats: mean value and number of days with exceeded thresholds
         """
-        self.daily['mean'] = self.daily['mean'].astype(float)
-        self.daily['date'] = self.daily['date'].astype('datetime64[M]')
-        monthly = self.daily.groupby(['station_id', 'date']).agg({'mean':
-                                                                  ['mean',
-                                                                   ('days_num',
-                                                                    'size'),
-                                                                      ('days_abv_norm', lambda x: sum(
-                                                                          x > 50)),
-                                                                      ('days_abv_200', lambda x: sum(
-                                                                          x > 200)),
-                                                                      ('days_abv_300', lambda x: sum(
-                                                                          x > 300))
-                                                                   ],
-                                                                  'max': 'max'
-                                                                  })
-
-        monthly.columns = monthly.columns.get_level_values(1)
+        # Daily stats may still be written in the background, so they are not modified here
+        date = self.daily['date'].to_numpy(dtype='datetime64[D]')
+        mean = self.daily['mean'].to_numpy(dtype=np.float64, na_value=np.nan)
+        monthly = self.daily.assign(date=date.astype('datetime64[M]').astype('datetime64[ns]'),
+                                    abv_norm=(mean > 50).astype('int8'),
+                                    abv_200=(mean > 200).astype('int8'),
+                                    abv_300=(mean > 300).astype('int8'))
+        monthly = monthly.groupby(['station_id', 'date'], sort=False, observed=True).agg(
+            mean=('mean', 'mean'),
+            days_num=('mean', 'size'),
+            days_abv_norm=('abv_norm', 'sum'),
+            days_abv_200=('abv_200', 'sum'),
+            days_abv_300=('abv_300', 'sum'),
+            max=('max', 'max'))
         monthly.reset_index(inplace=True)
-        monthly[['mean', 'max']] = monthly[[
-            'mean', 'max']].applymap(self._round_values)
+        monthly[['mean', 'max']] = _round_half_up(monthly[[
+            'mean', 'max']].to_numpy(dtype=np.float64, na_value=np.nan))
+        monthly[['mean', 'max']] = monthly[['mean', 'max']].astype('Int64')
         monthly[['days_abv_norm', 'days_abv_200', 'days_abv_300']] = monthly[[
             'days_abv_norm', 'days_abv_200', 'days_abv_300']].astype(int)
         monthly.sort_values(['station_id', 'date'],
                             ascending=True, inplace=True)
-        self.log.info(f"Calculated monthly statistics")
+        self.log.info("Calculated monthly statistics")
         return monthly
 
     def add_station_info(self, station_file):
@@ -242,23 +358,23 @@ class Awair:
         Loads csv with stations information and adds it to monthly stats
         """
         if not os.path.exists(station_file):
-            self.log.error(f"Station file does not exist")
+            self.log.error("Station file does not exist")
             sys.exit(1)
 
         stations = pd.read_csv(
-            station_file, float_precision='high', encoding='utf-8')
+            station_file, float_precision='high', dtype={'id': 'int32'}, encoding='utf-8').set_index('id')
         self.monthly['station_id'] = self.monthly['station_id'].astype(int)
-        self.monthly = self.monthly.merge(
-            stations, left_on='station_id', right_on='id', how='left')
-        self.monthly.drop('id', axis=1, inplace=True)
-        self.log.info(f"Monthly stats merged with station info")
+        self.monthly = self.monthly.join(stations, on='station_id', how='left')
+        self.log.info("Monthly stats merged with station info")
 
-    def perc_of_norm(self, norm=50, precision="1."):
+    def perc_of_norm(self, norm=50, decimals=0):
         """
         Calculates percent of an acceptable norm
         """
-        self.daily['perc_of_norm'] = self.daily['mean'].apply(
-            lambda x: decimal.Decimal(str(x / norm * 100)).quantize(decimal.Decimal(precision)))
+        mean = self.daily['mean'].to_numpy(dtype=np.float64, na_value=np.nan)
+        self.daily['perc_of_norm'] = _round_half_up(mean * 100 / norm, decimals)
+        if decimals == 0:
+            self.daily['perc_of_norm'] = self.daily['perc_of_norm'].astype('Int64')
         self.log.info("Calculated percent of an acceptable norm")
 
 
@@ -271,11 +387,15 @@ def main():
                         default='output', required=False)
     args = parser.parse_args()
 
-    awair_analysis = Awair(args.input_file)
-    awair_analysis.preprocess_data(args.output_dir)
-    awair_analysis.generate_hourly_stats(args.output_dir)
-    awair_analysis.generate_daily_stats(args.output_dir)
-    awair_analysis.generate_monthly_stats(args.stations_file, args.output_dir)
+    # Csv files are written in background threads while the next stats are calculated
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        awair_analysis = Awair(args.input_file, executor=executor)
+        awair_analysis.preprocess_data(args.output_dir)
+        awair_analysis.generate_hourly_stats(args.output_dir)
+        awair_analysis.generate_daily_stats(args.output_dir)
+        awair_analysis.generate_monthly_stats(args.stations_file, args.output_dir)
+        for export in awair_analysis.exports:
+            export.result()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,107 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import preprocessing
+
+OUTPUT_FILES = ['data.csv', 'hourly_stats.csv', 'daily_stats.csv', 'monthly_stats.csv']
+
+
+def write_sample(tmp_path):
+    """
+    Writes a small measurements file and a stations file with a quoted address
+    """
+    measure_time = pd.date_range('2019-03-31 20:00', '2019-05-01 04:00', freq='20min', tz='UTC')
+    data = pd.concat([pd.DataFrame({'station_id': station_id,
+                                    'measure_time': measure_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                    'value': [round((i * 7.31 + station_id * 13) % 250, 2)
+                                              for i in range(len(measure_time))]})
+                      for station_id in [1, 2]], ignore_index=True)
+    data.loc[10, 'value'] = 50.0
+    data.to_csv(tmp_path / 'measurements.csv', index=False)
+    pd.DataFrame({'id': [1, 2], 'station_name': ['Station 1', 'Station 2'],
+                  'station_address': ['Street 1, Katowice', 'Street 2'], 'district_id': [1, 2],
+                  'district': ['Centrum', 'Ligota'], 'lat': [50.2649, 50.2341],
+                  'lon': [19.0238, 18.9829]}).to_csv(tmp_path / 'stations.csv', index=False)
+
+
+def run_pipeline(tmp_path, output_dir):
+    output_dir.mkdir()
+    awair_analysis = preprocessing.Awair(str(tmp_path / 'measurements.csv'), logging.WARNING)
+    awair_analysis.preprocess_data(str(output_dir))
+    awair_analysis.generate_hourly_stats(str(output_dir))
+    awair_analysis.generate_daily_stats(str(output_dir))
+    awair_analysis.generate_monthly_stats(str(tmp_path / 'stations.csv'), str(output_dir))
+
+
+def test_pyarrow_and_pandas_outputs_are_identical(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    write_sample(tmp_path)
+    run_pipeline(tmp_path, tmp_path / 'pyarrow')
+    monkeypatch.setattr(preprocessing, 'pa', None)
+    monkeypatch.setattr(preprocessing, 'CSV_ENGINE', 'c')
+    run_pipeline(tmp_path, tmp_path / 'pandas')
+
+    for output_file in OUTPUT_FILES:
+        assert (tmp_path / 'pyarrow' / output_file).read_bytes() == \
+            (tmp_path / 'pandas' / output_file).read_bytes()
+
+
+def test_convert_datetime_parses_mixed_formats(tmp_path, monkeypatch):
+    monkeypatch.setattr(preprocessing, 'CSV_ENGINE', 'c')
+    (tmp_path / 'measurements.csv').write_text('station_id,measure_time,value\n'
+                                               '1,2019-04-01T10:00:00Z,10.0\n'
+                                               '1,2019-04-01 12:30:00+02:00,20.0\n')
+    awair_analysis = preprocessing.Awair(str(tmp_path / 'measurements.csv'), logging.WARNING)
+    awair_analysis.convert_datetime()
+
+    assert awair_analysis.data['measure_time'].tolist() == [
+        pd.Timestamp('2019-04-01 12:00', tz='Europe/Vienna'),
+        pd.Timestamp('2019-04-01 12:30', tz='Europe/Vienna')]
+
+
+def test_preprocess_data_removes_duplicates_for_any_sort_order(tmp_path):
+    (tmp_path / 'measurements.csv').write_text('station_id,measure_time,value\n'
+                                               '1,2019-04-01T10:00:00Z,10.0\n'
+                                               '2,2019-04-01T10:00:00Z,20.0\n'
+                                               '1,2019-04-01T10:00:00Z,10.0\n')
+    awair_analysis = preprocessing.Awair(str(tmp_path / 'measurements.csv'), logging.WARNING)
+    awair_analysis.preprocess_data(str(tmp_path), sort_order=['measure_time'])
+
+    assert len(awair_analysis.data) == 2
+
+
+def test_perc_of_norm_rounds_exact_ties_up(tmp_path):
+    (tmp_path / 'measurements.csv').write_text('station_id,measure_time,value\n'
+                                               '1,2019-04-01T10:00:00Z,10.0\n')
+    awair_analysis = preprocessing.Awair(str(tmp_path / 'measurements.csv'), logging.WARNING)
+    awair_analysis.daily = pd.DataFrame({'mean': pd.array([23, 1, 50], dtype='Int64')})
+    awair_analysis.perc_of_norm(norm=40)
+
+    assert awair_analysis.daily['perc_of_norm'].tolist() == [58, 3, 125]
+
+
+def test_stats_are_sorted_for_any_sort_order(tmp_path):
+    write_sample(tmp_path)
+    awair_analysis = preprocessing.Awair(str(tmp_path / 'measurements.csv'), logging.WARNING)
+    awair_analysis.preprocess_data(str(tmp_path), sort_order=['measure_time'])
+    awair_analysis.hourly = awair_analysis.hourly_stats()
+    hourly = awair_analysis.hourly
+    assert hourly['station_id'].is_monotonic_increasing
+    assert hourly.equals(hourly.sort_values(['station_id', 'date', 'hour'], ignore_index=True))
+
+    awair_analysis.hourly = hourly.sample(frac=1, random_state=0)
+    daily = awair_analysis.daily_stats()
+    assert daily['station_id'].is_monotonic_increasing
+    assert daily.equals(daily.sort_values(['station_id', 'date'], ignore_index=True))
+
+
+def test_round_half_up_ties_and_near_ties():
+    values = np.array([0.5, 1.5, 2.5, -2.5, 0.49999999999999994, 2.4999999999999996,
+                       -0.49999999999999994, 0.0, np.nan])
+
+    np.testing.assert_array_equal(preprocessing._round_half_up(values),
+                                  [1, 2, 3, -3, 0, 2, -0, 0, np.nan])
+    np.testing.assert_array_equal(preprocessing._round_half_up(np.array([0.25, 1.04]), 1), [0.3, 1.0])